@@ -1,5 +1,9 @@
 
+import copy
+import threading
+import uuid
 import dash
+import flask
 import dash_core_components as dcc
 import dash_bootstrap_components as dbc
 import dash_html_components as html
@@ -7,13 +11,35 @@ import dash_table
 from dash.dependencies import Input, Output, State
 import plotly.express as px
 import pandas as pd
+import data_source
 from data_source import *
+from cache import FIGURE_CACHE
+from prefetch import PREFETCHER, neighbours
+from export import export_api
+from jobs import submit_job, read_job, current_job, job_result
 
 
-app = dash.Dash(__name__, external_stylesheets=[dbc.themes.JOURNAL])
+# Initial callbacks are not fired: the layout is served with the outputs for
+# the default controls already in place (see serve_layout)
+app = dash.Dash(__name__, external_stylesheets=[dbc.themes.JOURNAL],
+                prevent_initial_callbacks=True)
 app.title = 'JRL: ML-Dk Scores'
 
 server = app.server
+server.register_blueprint(export_api)
+
+
+# Each request uses the data version current when it started, even if a new
+# one is swapped in meanwhile (see data_source: DATA VERSIONS)
+@server.before_request
+def pin_data():
+    pin_data_version()
+
+
+@server.teardown_request
+def unpin_data(exception=None):
+    unpin_data_version()
+
 
 # the style arguments for the sidebar. We use position:fixed and a fixed width
 SIDEBAR_STYLE = {
@@ -124,6 +150,20 @@ controls = dbc.Card(
                 ),
             ]
         ),
+        dbc.FormGroup(
+            [
+                dbc.Label("Shaded bands:", className='font-weight-bold'),
+                dbc.RadioItems(
+                    id="band-value",
+                    options=[
+                        {'label': value, 'value': key} for key, value in band_types.items()
+                    ],
+                    value='std',
+                    labelCheckedStyle={"color": "#FF9191", 'font-weight': 'bold'},
+                    inline=True
+                ),
+            ]
+        ),
         html.Hr(style={'background-color': '#666666'}),
         dbc.FormGroup(
             [
@@ -163,6 +203,21 @@ controls = dbc.Card(
                     value='sec',
                     labelCheckedStyle={"color": "#F5D5AB"}
                 ),
+                # Progress of the DR computed by a background job
+                html.Div(
+                    id='job-div',
+                    children=[
+                        dbc.Progress(id='job-progress', value=0, striped=True,
+                                     animated=True, className='mt-2'),
+                        html.Small(id='job-message'),
+                    ],
+                    style={'display': 'none'}
+                ),
+                dcc.Interval(id='job-interval', interval=1000, disabled=True),
+                dcc.Store(id='job-id'),
+                dcc.Store(id='job-done'),
+                # Per browser tab id (set by serve_layout), see session_key
+                dcc.Store(id='session-id', storage_type='session'),
                 html.Br(),
                 dbc.Label("Point's size by:", className='font-weight-bold'),
                 dbc.RadioItems(
@@ -228,6 +283,40 @@ violin_plot = [
     )
 ]
 
+summary_plot = [
+    html.H5(id='summary-title', className='text-center'),
+    dbc.RadioItems(
+        id='summary-value',
+        options=[
+            {'label': value, 'value': key} for key, value in summary_values.items()
+        ],
+        value='gain_best',
+        labelCheckedStyle={'font-weight': 'bold'},
+        inline=True,
+        className='text-center'
+    ),
+    dcc.Graph(
+        id='summary-plot',
+        config=plotly_conf
+    )
+]
+
+comparison_plot = [
+    html.H5(id='comparison-title', className='text-center'),
+    dbc.Checklist(
+        id='compare-proteins',
+        options=[
+            {'label': protein_name, 'value': protein_name} for protein_name in mos_info
+        ],
+        value=[],
+        labelCheckedStyle={'font-weight': 'bold'},
+        inline=True,
+        switch=True,
+        className='text-center'
+    ),
+    dbc.Row(id='comparison-div')
+]
+
 # Plot Sections
 plot_section = [
     dbc.Row([
@@ -235,6 +324,8 @@ plot_section = [
         dbc.Col(n_confs_slider, md=12, className='mb-5'),
         dbc.Col(violin_plot, lg=7, md=12),
         dbc.Col(scatter_plot, lg=5, md=12),
+        dbc.Col(summary_plot, md=12, className='mt-5'),
+        dbc.Col(comparison_plot, md=12, className='mt-5'),
        ],
     className='mb-5'
     )
@@ -243,7 +334,7 @@ plot_section = [
 #***********
 # APP LAYOUT
 #***********
-app.layout = dbc.Container(
+base_layout = dbc.Container(
     [
         html.Br(),
         dbc.Row(
@@ -326,7 +417,7 @@ def render_title(split, selector, metric, protein_name, dr_method, protein_secti
     split_name = split_names[split]
     selector_name = selector_names[selector]
     metric_name = metric_names[metric]
-    if protein_section == 'vol_pkt':
+    if protein_section in ('vol_pkt', 'dksc'):
         dr_method = 'mds'
     dr_method_name = dr_methods_names[dr_method]
     prot_section = prot_section_dr[protein_section]
@@ -379,23 +470,283 @@ def render_title(split, selector, metric, protein_name, dr_method, protein_secti
         Input("point-size-by", "value"),
         Input("n-confs-slider", "value"),
         Input("ml-or-cs", "value"),
+        Input("band-value", "value"),
+        Input("job-done", "data"),
+    ],
+    [
+        State('session-id', 'data'),
     ]
 )
 def render_plot(split, selector, metric, 
     protein_name, show_benchmarks, dr_method, 
-    prot_section, point_size_by, n_confs, methodology):
+    prot_section, point_size_by, n_confs, methodology, band='std', job_done=None,
+    session_id=None):
 
     preselected_confs = get_preselected_confs(split, selector, n_confs, protein_name)
 
-    line_plot = line_plot_metrics(split, selector, metric, protein_name, n_confs, methodology)
+    line_plot = line_plot_metrics(split, selector, metric, protein_name, n_confs, methodology,
+                                  band=band)
 
     violin_plot = violin_plot_metrics(metric, protein_name, show_benchmarks, preselected_confs)
 
-    scatter_plot = mds_plot(protein_name, dr_method, prot_section, point_size_by, preselected_confs)
+    if dr_job_pending(protein_name, prot_section):
+        job = current_job(dr_jobs[prot_section], protein_name)
+        if job is not None and job['status'] == 'failed':
+            scatter_plot = pending_plot(f"Embedding failed ({job['message']}).<br>"
+                                        'Select the section again to retry.')
+        else:
+            scatter_plot = pending_plot('Computing the embedding...')
+    else:
+        scatter_plot = mds_plot(protein_name, dr_method, prot_section, point_size_by, preselected_confs)
     
     mtd_table = render_mtd_table(protein_name, preselected_confs)
+
+    # Warm the figures the user is likely to ask for next (not for the
+    # layout defaults: no user is behind them)
+    if not building_defaults():
+        PREFETCHER.schedule(session_key(session_id), prefetch_tasks(split, selector, metric,
+            protein_name, show_benchmarks, dr_method, prot_section, point_size_by,
+            n_confs, methodology, band))
     
     return line_plot, violin_plot, scatter_plot, mtd_table
 
+
+# Summary heatmap: all the settings at once, from the precomputed table
+@app.callback(
+    [
+        Output(component_id='summary-plot', component_property='figure'),
+        Output(component_id='summary-title', component_property='children'),
+    ],
+    [
+        Input("protein-value", "value"),
+        Input("ml-or-cs", "value"),
+        Input("summary-value", "value"),
+    ]
+)
+def render_summary(protein_name, methodology, value):
+    summary_title = html.P(children=[
+        html.Span(f"{protein_name} - ", className='font-weight-bold'),
+        html.Span(methodologies_dic[methodology] + ': ', className='font-weight-light'),
+        html.Span('best ', className='font-weight-light font-italic'),
+        html.Span('k', className='font-italic'),
+        html.Span(' across all settings', className='font-weight-light font-italic'),
+    ])
+    return summary_heatmap(protein_name, methodology, value), summary_title
+
+
+# Multi-target comparison: same settings, one line plot per target
+@app.callback(
+    [
+        Output(component_id='comparison-div', component_property='children'),
+        Output(component_id='comparison-title', component_property='children'),
+    ],
+    [
+        Input("split-value", "value"),
+        Input("selector-value", "value"),
+        Input("metric-value", "value"),
+        Input("compare-proteins", "value"),
+        Input("n-confs-slider", "value"),
+        Input("ml-or-cs", "value"),
+        Input("band-value", "value"),
+    ]
+)
+def render_comparison(split, selector, metric, protein_names, n_confs, methodology, band):
+    comparison_title = html.P(children=[
+        html.Span('Target comparison: ', className='font-weight-bold'),
+        html.Span(metric_names[metric]),
+        html.Span(' - '),
+        html.Span(split_names[split]),
+        html.Span(' Splitting', className='font-weight-light font-italic'),
+        html.Span(' - '),
+        html.Span(selector_names[selector]),
+        html.Span(' Selection', className='font-weight-light font-italic'),
+    ])
+    figures = comparison_figures(split, selector, metric, protein_names, n_confs, methodology,
+                                 band)
+    comparison = [
+        dbc.Col([
+            html.H6(protein_name, className='text-center font-weight-bold'),
+            # Targets without per-repeat scores keep the mean ± std bands
+            html.P(f"{band_types['std']} bands: no per-repeat scores",
+                   className='text-center font-italic small')
+            if band == 'ci' and get_bootstrap_bands(protein_name, methodology) is None
+            else None,
+            dcc.Graph(figure=figure, config=plotly_conf)
+        ], lg=12 // max(len(figures), 1), md=12)
+        for protein_name, figure in zip(protein_names, figures)
+    ]
+    return comparison, comparison_title
+
+
+# Bootstrap CI bands only for the results with per-repeat scores
+@app.callback(
+    [
+        Output(component_id='band-value', component_property='options'),
+        Output(component_id='band-value', component_property='value'),
+    ],
+    [
+        Input("protein-value", "value"),
+        Input("ml-or-cs", "value"),
+    ],
+    [
+        State('band-value', 'value'),
+    ]
+)
+def set_band_options(protein_name, methodology, band):
+    available = get_bootstrap_bands(protein_name, methodology) is not None
+    options = [
+        {'label': value if key != 'ci' or available else f'{value} (no per-repeat scores)',
+         'value': key, 'disabled': key == 'ci' and not available}
+        for key, value in band_types.items()
+    ]
+    return options, 'std' if band == 'ci' and not available else dash.no_update
+
+
+def session_key(session_id=None):
+    # The id of the browser tab; without it, the client address (first
+    # X-Forwarded-For hop: behind the Heroku router remote_addr is the router)
+    if session_id is not None:
+        return session_id
+    if not flask.has_request_context():
+        return None
+    request = flask.request
+    forwarded_for = request.headers.get('X-Forwarded-For')
+    address = forwarded_for.split(',')[0].strip() if forwarded_for else request.remote_addr
+    return (address, request.headers.get('User-Agent'))
+
+
+def prefetch_tasks(split, selector, metric, 
+    protein_name, show_benchmarks, dr_method, 
+    prot_section, point_size_by, n_confs, methodology, band):
+    tasks = []
+    # Other metrics for the same split/selector
+    preselected_confs = get_preselected_confs(split, selector, n_confs, protein_name)
+    for other_metric in neighbours(metric_names, metric):
+        tasks += [
+            (line_plot_metrics, (split, selector, other_metric, protein_name, n_confs, methodology),
+             dict(band=band)),
+            (violin_plot_metrics, (other_metric, protein_name, show_benchmarks, preselected_confs), {}),
+        ]
+    # Other selectors for the same metric
+    for other_selector in neighbours(selector_names, selector):
+        other_confs = get_preselected_confs(split, other_selector, n_confs, protein_name)
+        tasks += [
+            (line_plot_metrics, (split, other_selector, metric, protein_name, n_confs, methodology),
+             dict(band=band)),
+            (violin_plot_metrics, (metric, protein_name, show_benchmarks, other_confs), {}),
+            (render_mtd_table, (protein_name, other_confs), {}),
+        ]
+        if not dr_job_pending(protein_name, prot_section):
+            tasks.append((mds_plot, (protein_name, dr_method, prot_section,
+                                     point_size_by, other_confs), {}))
+    return tasks
+
+
+# BACKGROUND JOBS
+# DR sections computed on demand (see jobs.py): the job is submitted when
+# the section is selected and its progress polled until the result is ready
+def dr_job_pending(protein_name, prot_section):
+    return prot_section in dr_jobs and job_result(dr_jobs[prot_section], protein_name) is None
+
+
+@app.callback(
+    Output(component_id='job-id', component_property='data'),
+    [
+        Input("protein-value", "value"),
+        Input("prot-section-value", "value"),
+    ]
+)
+def start_dr_job(protein_name, prot_section):
+    if not dr_job_pending(protein_name, prot_section):
+        return None
+    return submit_job(dr_jobs[prot_section], protein_name)
+
+
+@app.callback(
+    [
+        Output(component_id='job-progress', component_property='value'),
+        Output(component_id='job-message', component_property='children'),
+        Output(component_id='job-div', component_property='style'),
+        Output(component_id='job-interval', component_property='disabled'),
+        Output(component_id='job-done', component_property='data'),
+    ],
+    [
+        Input("job-interval", "n_intervals"),
+        Input("job-id", "data"),
+    ]
+)
+def poll_dr_job(n_intervals, job_id):
+    record = read_job(job_id) if job_id else None
+    if record is None:
+        return 0, None, {'display': 'none'}, True, dash.no_update
+    finished = record['status'] in ('done', 'failed')
+    return (int(record['progress'] * 100), record['message'], {'display': 'block'},
+            finished, job_id if record['status'] == 'done' else dash.no_update)
+
+
+# Cache and prefetch counters, data version
+@server.route('/_stats')
+def stats():
+    return flask.jsonify(cache=FIGURE_CACHE.stats(), prefetch=PREFETCHER.stats(),
+                         data_version=str(current_version().version),
+                         data_reload_error=data_source.last_reload_error)
+
+
+@server.route('/_jobs/<job_id>')
+def job_status(job_id):
+    record = read_job(job_id)
+    if record is None:
+        return flask.jsonify(error=f'Unknown job: {job_id}'), 404
+    return flask.jsonify(record)
+
+#***************
+# DEFAULT OUTPUTS
+#***************
+_defaults = threading.local()
+
+def building_defaults():
+    # True while the callbacks run for the layout defaults: their side
+    # effects (prefetch) are skipped
+    return getattr(_defaults, 'active', False)
+
+
+def default_outputs():
+    # Run every callback with the default values of the controls; the
+    # figures come from the cache after the first call of a data version
+    outputs = {}
+    _defaults.active = True
+    try:
+        for callback_id, callback in app.callback_map.items():
+            args = [getattr(base_layout[dep['id']], dep['property'], None)
+                    for dep in callback['inputs'] + callback['state']]
+            values = callback['callback'].__wrapped__(*args)
+            output_ids = callback_id.strip('.').split('...')
+            if not callback_id.startswith('..'):
+                values = [values]  # Single output
+            for output_id, value in zip(output_ids, values):
+                if value is not dash.no_update:
+                    outputs[output_id] = value
+    finally:
+        _defaults.active = False
+    return outputs
+
+
+def serve_layout():
+    # One response with the page fully rendered for the default controls
+    layout = copy.deepcopy(base_layout)
+    for output_id, value in default_outputs().items():
+        component_id, component_property = output_id.rsplit('.', 1)
+        setattr(layout[component_id], component_property, value)
+    # Kept by the tab across reloads (session storage)
+    layout['session-id'].data = uuid.uuid4().hex
+    return layout
+
+
+app.layout = serve_layout
+
+# Build the default figures at startup
+with use_data_version():
+    default_outputs()
+
 if __name__ == '__main__':
     app.run_server(debug=True)
\ No newline at end of file
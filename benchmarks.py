@@ -0,0 +1,95 @@
+'''
+Figure payload and build-cost benchmarks.
+
+    python benchmarks.py render-modes
+    python benchmarks.py downsampling
+    python benchmarks.py bootstrap
+
+Only server-side cost is measured (build + JSON serialization, payload
+size). WebGL and SVG traces carry the same data; the WebGL gain is in the
+browser's pan/zoom cost, which needs a browser to be measured.
+'''
+import argparse
+import gzip
+import itertools
+import time
+
+import plotly.io as pio
+
+from data_source import *
+
+
+def time_figure(build, repeats=5):
+    # Best-of build + JSON serialization time (ms) and payload size (bytes)
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        payload = pio.to_json(build())
+        best = min(best, time.perf_counter() - start)
+    payload = payload.encode()
+    return 1000 * best, len(payload), len(gzip.compress(payload))
+
+
+def bench_render_modes():
+    print(f"{'figure':<34} {'mode':<6} {'points':>7} {'build ms':>9} "
+          f"{'json kB':>8} {'gzip kB':>8}")
+    for protein_name, methodology in itertools.product(mos_info, methodologies_dic):
+        preselected_confs = get_preselected_confs('rand', 'LR', 50, protein_name)
+        builders = {
+            f'line {protein_name} {methodology}': lambda mode: line_plot_metrics.__wrapped__(
+                'rand', 'LR', 'roc_auc', protein_name, 50, methodology, render_mode=mode),
+        }
+        if methodology == 'ml':
+            builders[f'mds {protein_name}'] = lambda mode: mds_plot.__wrapped__(
+                protein_name, 'mds', 'sec', 'LigMass', preselected_confs, render_mode=mode)
+        for name, build in builders.items():
+            n_points = sum(len(trace.x) for trace in build('svg').data)
+            for mode in ['svg', 'webgl']:
+                ms, size, gz_size = time_figure(lambda: build(mode))
+                print(f'{name:<34} {mode:<6} {n_points:>7} {ms:>9.1f} '
+                      f'{size / 1024:>8.1f} {gz_size / 1024:>8.1f}')
+
+
+def bench_downsampling():
+    # Synthetic mean/std curves of growing ensemble length
+    rng = np.random.default_rng(0)
+    n_out = get_point_budget()
+    print(f'point budget: {n_out} per curve')
+    print(f"{'k confs':>8} {'points out':>10} {'time ms':>8}")
+    for n_confs in [402, 4000, 40000, 400000]:
+        k = pd.RangeIndex(1, n_confs + 1)
+        X_mean = pd.DataFrame({'LogReg': 0.7 + np.cumsum(rng.normal(0, 0.002, n_confs))}, index=k)
+        X_std = pd.DataFrame({'LogReg': np.abs(rng.normal(0.05, 0.01, n_confs))}, index=k)
+        start = time.perf_counter()
+        indices = downsample_curve(X_mean, X_mean - X_std, X_mean + X_std, 'LogReg',
+                                   n_out, keep_x=50)
+        ms = 1000 * (time.perf_counter() - start)
+        print(f'{n_confs:>8} {len(indices):>10} {ms:>8.1f}')
+
+
+def bench_bootstrap():
+    # Bootstrap bands of synthetic per-repeat scores: all the
+    # (split, selector, metric, classifier) series of a target at once
+    rng = np.random.default_rng(0)
+    print(f'resamples: {bootstrap_resamples}')
+    print(f"{'series':>8} {'repeats':>8} {'k confs':>8} {'time s':>8}")
+    for n_series, n_repeats, n_confs in [(48, 10, 402), (384, 10, 402), (384, 30, 402)]:
+        scores = rng.uniform(0.4, 1.0, size=(n_series, n_repeats, n_confs))
+        start = time.perf_counter()
+        bootstrap_bands(scores)
+        seconds = time.perf_counter() - start
+        print(f'{n_series:>8} {n_repeats:>8} {n_confs:>8} {seconds:>8.2f}')
+
+
+benchmarks = {
+    'render-modes': bench_render_modes,
+    'downsampling': bench_downsampling,
+    'bootstrap': bench_bootstrap,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=list(benchmarks))
+    args = parser.parse_args()
+    benchmarks[args.benchmark]()
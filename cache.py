@@ -0,0 +1,147 @@
+import functools
+import inspect
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import pandas as pd
+
+
+# FIGURE CACHE
+# Built figures/tables are shared read-only between requests (and threads)
+# of a worker: callers must not modify the returned objects.
+class FigureCache:
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._prefetched = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.prefetch_hits = 0
+
+    def get(self, key):
+        # Returns (found, value)
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            self._data.move_to_end(key)
+            # First use of a prefetched entry
+            if key in self._prefetched:
+                self._prefetched.discard(key)
+                self.prefetch_hits += 1
+            return True, self._data[key]
+
+    def put(self, key, value, prefetched=False):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if prefetched:
+                self._prefetched.add(key)
+            while len(self._data) > self.maxsize:
+                old_key, _ = self._data.popitem(last=False)
+                self._prefetched.discard(old_key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._prefetched.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(size=len(self._data), hits=self.hits, misses=self.misses,
+                        prefetch_hits=self.prefetch_hits,
+                        prefetched_unused=len(self._prefetched))
+
+
+# Entries are ~0.3 MB each (figure objects): the default keeps the current
+# figures plus one round of prefetched neighbours, ~20 MB per worker
+FIGURE_CACHE = FigureCache(maxsize=int(os.environ.get('FIGURE_CACHE_SIZE', 64)))
+
+
+# Keys include the data version (set by data_source) so entries built from
+# an older version of the data are never served after a reload
+def get_data_version():
+    return None
+
+
+def set_version_getter(getter):
+    global get_data_version
+    get_data_version = getter
+
+
+@functools.lru_cache(maxsize=None)
+def get_signature(func):
+    return inspect.signature(func)
+
+
+def make_key(func, args, kwargs):
+    # Hashable key from the builder arguments (lists/Series become tuples).
+    # Arguments are bound to the signature, with the defaults applied, so
+    # positional, keyword and default values give the same key.
+    def freeze(value):
+        if isinstance(value, (list, tuple, pd.Series, pd.Index)):
+            return tuple(freeze(v) for v in value)
+        if hasattr(value, 'item'):  # numpy scalars
+            return value.item()
+        return value
+    bound = get_signature(func).bind(*args, **kwargs)
+    bound.apply_defaults()
+    return (get_data_version(), func.__name__, tuple(
+        (name, freeze(value)) for name, value in bound.arguments.items()))
+
+
+# Single flight: concurrent misses of the same key (e.g. render_plot and
+# render_comparison for the same input change) wait for one build
+_building = {}
+_building_lock = threading.Lock()
+
+
+def build_once(key, builder, args, kwargs, prefetched=False):
+    with _building_lock:
+        # Built by another thread since the caller's miss
+        if key in FIGURE_CACHE:
+            return None if prefetched else FIGURE_CACHE.get(key)[1]
+        future = _building.get(key)
+        owner = future is None
+        if owner:
+            future = _building[key] = Future()
+    if not owner:
+        return future.result()
+    try:
+        value = builder(*args, **kwargs)
+        FIGURE_CACHE.put(key, value, prefetched=prefetched)
+        future.set_result(value)
+        return value
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _building_lock:
+            del _building[key]
+
+
+def cached(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = make_key(func, args, kwargs)
+        found, value = FIGURE_CACHE.get(key)
+        if not found:
+            value = build_once(key, func, args, kwargs)
+        return value
+    return wrapper
+
+
+def warm(func, *args, **kwargs):
+    # Build and store an entry for a cached builder unless it is already there
+    builder = getattr(func, '__wrapped__', func)
+    key = make_key(builder, args, kwargs)
+    if key not in FIGURE_CACHE:
+        build_once(key, builder, args, kwargs, prefetched=True)
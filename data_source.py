@@ -2,21 +2,357 @@ import plotly.graph_objects as go
 import pandas as pd
 import numpy as np
 import pickle
+import os
+import threading
+import time
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 import dash_table
 import dash_html_components as html
 
+import cache
+from cache import cached
+
+# Memory footprint
+# String keys repeated across thousands of rows are stored as categoricals
+categorical_keys = ['split', 'selector', 'metric', 'desc', 'classifier',
+                    'consensus', 'Conformation', 'Ligand']
+# Tables whose float values are displayed verbatim (DataTable, violin hover
+# text) keep float64
+float64_tables = ['df_PROT_METADATA', 'df_DKSC_METRICS']
+
+def compact_frame(df, downcast_floats=True):
+    # Float scores are only plotted with 2 decimals: float32 is enough
+    dtypes = {}
+    for col, dtype in df.dtypes.items():
+        if col in categorical_keys and dtype == 'object':
+            dtypes[col] = 'category'
+        elif downcast_floats and dtype == 'float64':
+            dtypes[col] = 'float32'
+    df = df.astype(dtypes) if len(dtypes) > 0 else df.copy()
+
+    # Conformation indices (e.g. df_SELECTED_CONFS) fit in small integers
+    int_cols = df.select_dtypes(include='integer').columns
+    for col in int_cols:
+        df[col] = pd.to_numeric(df[col], downcast='integer')
+
+    # MultiIndex levels (split, selector, metric, ...) are already stored
+    # as integer codes over their unique values, so the index is kept as is
+    return df
+
+
+def compact_app_data(data):
+    compacted = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            compacted[key] = compact_app_data(value)
+        elif isinstance(value, pd.DataFrame):
+            compacted[key] = compact_frame(value,
+                downcast_floats=key not in float64_tables)
+        else:
+            compacted[key] = value
+    return compacted
+
+
+def memory_report(data, prefix=()):
+    # Deep memory usage (bytes) of each table, including its index
+    rows = []
+    for key, value in data.items():
+        if isinstance(value, dict):
+            rows.append(memory_report(value, prefix + (key,)))
+        elif isinstance(value, pd.DataFrame):
+            rows.append(pd.DataFrame({
+                'table': ['/'.join(prefix + (key,))],
+                'rows': [value.shape[0]],
+                'columns': [value.shape[1]],
+                'bytes': [value.memory_usage(index=True, deep=True).sum()]
+            }))
+    if len(rows) == 0:
+        return pd.DataFrame(columns=['table', 'rows', 'columns', 'bytes'])
+    return pd.concat(rows, ignore_index=True)
+
+
+# Read-only data layer
+# The loaded tables are shared by every request (and thread) of a worker:
+# their arrays are frozen so any in-place write raises instead of leaking
+# into other requests. Builders work on the copies returned by pandas.
+def freeze_frame(df):
+    # Consolidated first: otherwise the first .values/.T consolidates the
+    # blocks into a new (writable) array that replaces the frozen ones
+    df._consolidate_inplace()
+    manager = getattr(df, '_mgr', None) or df._data
+    for block in manager.blocks:
+        values = block.values
+        # Categorical codes / datetime arrays wrap a numpy array
+        values = getattr(values, '_codes', getattr(values, '_ndarray', values))
+        if isinstance(values, np.ndarray):
+            values.flags.writeable = False
+    return df
+
+
+def freeze_app_data(data):
+    for value in data.values():
+        if isinstance(value, dict):
+            freeze_app_data(value)
+        elif isinstance(value, pd.DataFrame):
+            freeze_frame(value)
+    return data
+
+
+def data_fingerprint(data):
+    # Content hash of every table (values, index, columns and dtypes)
+    fingerprint = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            fingerprint.update({f'{key}/{k}': v for k, v in
+                                data_fingerprint(value).items()})
+        elif isinstance(value, pd.DataFrame):
+            fingerprint[key] = (
+                pd.util.hash_pandas_object(value, index=True).sum(),
+                tuple(value.columns), tuple(value.dtypes.astype(str))
+            )
+    return fingerprint
+
+
 # Read the pickle file
 app_data = './dash_app_data.pkl'
-with open(app_data, 'rb') as f:
-    APP_DATA = pickle.load(f)
 
-# Assing protein data
-FXA_DATA = APP_DATA['FXA']
-CDK2_DATA = APP_DATA['CDK2']
-
-# Assing values: ML Data
-ALL_RESULTS_FXa = FXA_DATA['dict_ML_RESULTS']
-ALL_RESULTS_CDK2 = CDK2_DATA['dict_ML_RESULTS']
+# DELTA SEGMENTS (incremental ingestion, see ingest.py)
+# New conformations are stored as small pickles next to the data file:
+# <segments_dir>/<protein key>/<seq>.pkl with the new rows of the
+# per-conformation tables. They are appended to the loaded data in order;
+# the data file records the last segment already merged into it.
+segments_dir = os.environ.get('DATA_SEGMENTS_DIR', './data_segments')
+conformation_tables = ['df_PROT_METADATA', 'df_DIM_REDUCT', 'df_DKSC_METRICS']
+
+def list_segments(protein_key, after=0):
+    # [(seq, path)] of the segments of a protein newer than `after`
+    directory = os.path.join(segments_dir, protein_key)
+    if not os.path.isdir(directory):
+        return []
+    segments = [(int(name[:-4]), os.path.join(directory, name))
+                for name in os.listdir(directory)
+                if name.endswith('.pkl') and name[:-4].isdigit()]
+    return sorted(segment for segment in segments if segment[0] > after)
+
+
+def read_segment(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def compact_delta(delta):
+    return {key: compact_frame(table, downcast_floats=key not in float64_tables)
+            for key, table in delta.items()}
+
+
+def append_conformations(data, protein_key, delta):
+    # New data dict sharing every untouched table with `data`; only the
+    # per-conformation tables of the protein are extended
+    protein_data = dict(data[protein_key])
+    for key in conformation_tables:
+        if key in delta and delta[key].shape[0] > 0:
+            table = pd.concat([protein_data[key], delta[key]])
+            protein_data[key] = freeze_frame(compact_frame(table,
+                downcast_floats=key not in float64_tables))
+    data = dict(data)
+    data[protein_key] = protein_data
+    return data
+
+
+def load_app_data(path=app_data):
+    # Returns the data and the last segment applied of each protein
+    with open(path, 'rb') as f:
+        raw = pickle.load(f)
+    applied = dict(raw.pop('merged_segments', {}))
+    data = freeze_app_data(compact_app_data(raw))
+    for protein_key in data:
+        for seq, segment in list_segments(protein_key, applied.get(protein_key, 0)):
+            data = append_conformations(data, protein_key, read_segment(segment))
+            applied[protein_key] = seq
+    return data, applied
+
+
+# DATA VERSIONS (hot reload)
+# The loaded data is an immutable snapshot. A watcher thread detects a new
+# data file (or new delta segments), loads it in the background and swaps
+# the current snapshot atomically. Each request pins the snapshot it started
+# with, so in-flight requests finish on the old data while new ones see the
+# new data.
+class DataVersion:
+    def __init__(self, data, file_version, applied_segments, derived=None):
+        self.data = data
+        self.file_version = file_version
+        self.applied_segments = applied_segments
+        self.version = (file_version, tuple(sorted(applied_segments.items())))
+        # Precomputed indexes/aggregates of this version
+        self._derived = dict(derived or {})
+        self._lock = threading.Lock()
+
+    def derived(self, name, builder):
+        # Computed once per data version; dropped with the version
+        with self._lock:
+            if name not in self._derived:
+                self._derived[name] = builder(self.data)
+            return self._derived[name]
+
+    # Results computed outside the process (see jobs.py) for this version
+    def publish(self, name, value):
+        with self._lock:
+            self._derived[name] = value
+
+    def get_published(self, name):
+        with self._lock:
+            return self._derived.get(name)
+
+
+def data_file_version(path=app_data):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+_swap_lock = threading.Lock()
+_reload_lock = threading.Lock()
+_pinned = threading.local()
+_file_version = data_file_version()
+_data, _applied = load_app_data()
+DATA_VERSION = DataVersion(_data, _file_version, _applied)
+
+
+def current_version():
+    pinned = getattr(_pinned, 'version', None)
+    return pinned if pinned is not None else DATA_VERSION
+
+
+@contextlib.contextmanager
+def use_data_version(version=None):
+    # Pin a data version for the current thread (a request, a background task)
+    previous = getattr(_pinned, 'version', None)
+    _pinned.version = version if version is not None else DATA_VERSION
+    try:
+        yield _pinned.version
+    finally:
+        _pinned.version = previous
+
+
+def pin_data_version():
+    _pinned.version = DATA_VERSION
+
+
+def unpin_data_version():
+    _pinned.version = None
+
+
+def set_module_data(data):
+    # Module-level aliases of the current data
+    global APP_DATA, FXA_DATA, CDK2_DATA, ALL_RESULTS_FXa, ALL_RESULTS_CDK2
+    APP_DATA = data
+
+    # Assing protein data
+    FXA_DATA = APP_DATA['FXA']
+    CDK2_DATA = APP_DATA['CDK2']
+
+    # Assing values: ML Data
+    ALL_RESULTS_FXa = FXA_DATA['dict_ML_RESULTS']
+    ALL_RESULTS_CDK2 = CDK2_DATA['dict_ML_RESULTS']
+
+
+# Precomputed tables of every data version: name -> builder(data)
+derived_tables = {}
+# Incremental update of a derived table when conformations are appended:
+# name -> updater(old_value, new_data, protein_key, delta)
+derived_appenders = {}
+
+def precompute_derived(data_version):
+    for name, builder in derived_tables.items():
+        data_version.derived(name, builder)
+    return data_version
+
+
+def swap_data(data, file_version, applied_segments, derived=None):
+    global DATA_VERSION
+    # Derived tables are built before the swap, off the request path
+    new_version = precompute_derived(
+        DataVersion(data, file_version, applied_segments, derived))
+    with _swap_lock:
+        DATA_VERSION = new_version
+        set_module_data(data)
+    # Entries of the old version can't be hit anymore: free them
+    cache.FIGURE_CACHE.clear()
+
+
+def apply_new_segments(data_version):
+    # Append the segments not applied yet; derived tables are updated with
+    # the delta only. Returns None if there is nothing new.
+    data = data_version.data
+    applied = dict(data_version.applied_segments)
+    derived = dict(data_version._derived)
+    for protein_key in data:
+        for seq, segment in list_segments(protein_key, applied.get(protein_key, 0)):
+            delta = compact_delta(read_segment(segment))
+            data = append_conformations(data, protein_key, delta)
+            derived = {name: derived_appenders[name](value, data, protein_key, delta)
+                       for name, value in derived.items() if name in derived_appenders}
+            applied[protein_key] = seq
+    if applied == data_version.applied_segments:
+        return None
+    return data, applied, derived
+
+
+# Error of the last failed reload (None once a reload succeeds)
+last_reload_error = None
+
+def reload_if_changed(path=app_data):
+    # Returns True if a new data version was swapped in
+    global last_reload_error
+    with _reload_lock:
+        try:
+            file_version = data_file_version(path)
+        except OSError:
+            return False
+        try:
+            if file_version != DATA_VERSION.file_version:
+                data, applied = load_app_data(path)
+                derived = None
+            else:
+                update = apply_new_segments(DATA_VERSION)
+                if update is None:
+                    return False
+                data, applied, derived = update
+            # The derived tables are built here too: a builder failing on
+            # the new data leaves the current version in place
+            swap_data(data, file_version, applied, derived)
+        except Exception as e:
+            # File still being written (or invalid): keep serving the current
+            # version and retry on the next check
+            last_reload_error = f'{type(e).__name__}: {e}'
+            return False
+        last_reload_error = None
+        return True
+
+
+def start_data_watcher(interval):
+    def watch():
+        global last_reload_error
+        while True:
+            time.sleep(interval)
+            try:
+                reload_if_changed()
+            except Exception as e:
+                # The watcher must outlive any error
+                last_reload_error = f'{type(e).__name__}: {e}'
+    watcher = threading.Thread(target=watch, name='data-watcher', daemon=True)
+    watcher.start()
+    return watcher
+
+
+set_module_data(DATA_VERSION.data)
+cache.set_version_getter(lambda: current_version().version)
+
+# Seconds between checks of the data file (0 disables hot reload)
+data_reload_interval = float(os.environ.get('DATA_RELOAD_INTERVAL', 30))
+if data_reload_interval > 0:
+    start_data_watcher(data_reload_interval)
 
 # Mol libraries info
 fxa_mols = dict(num_mols=6233, num_actives=300)
@@ -25,12 +361,10 @@ mos_info = {'CDK2': cdk2_mols,
             'FXa': fxa_mols}
 
 # Parse the data from the dictionary
+protein_keys = {'FXa': 'FXA', 'CDK2': 'CDK2'}
+
 def get_data(protein_name, key):
-    if protein_name == 'FXa':
-        data = FXA_DATA[key]
-    elif protein_name == 'CDK2':
-        data = CDK2_DATA[key]
-    return data 
+    return current_version().data[protein_keys[protein_name]][key]
 
 # plotly configurations
 mode_bar_buttons = ["toImage", "autoScale2d",
@@ -117,9 +451,13 @@ dr_methods_names = {
 prot_section_dr = {
     'sec'    : 'Secondary Structure (Ca)',
     'pkt'    : 'Pocket Residues (Ca)',
-    'vol_pkt': 'Pocket Shape (POVME) (cMDS)'
+    'vol_pkt': 'Pocket Shape (POVME) (cMDS)',
+    'dksc'   : 'Docking Metrics Profile (cMDS, on demand)'
 }
 
+# Sections whose embedding is computed by a background job (see jobs.py)
+dr_jobs = {'dksc': 'cmds_dksc'}
+
 point_size_by = {
     'LigMass'            : 'Ligand MW',
     'Pocket Volume (Pkt)': 'Pocket Volume (A)',
@@ -152,6 +490,19 @@ def get_preselected_confs(split, selector, n_confs, protein_name):
     return selected_confs
 
 
+# WebGL rendering
+# Figures with more points than this use WebGL (Scattergl) traces instead of
+# SVG ones, keeping pan/zoom fluid for large ensembles
+webgl_point_threshold = int(os.environ.get('WEBGL_POINT_THRESHOLD', 5000))
+
+def get_scatter_class(n_points, render_mode='auto'):
+    # render_mode: 'auto' (by point count), 'svg' or 'webgl'
+    if render_mode == 'webgl' or (
+            render_mode == 'auto' and n_points > webgl_point_threshold):
+        return go.Scattergl
+    return go.Scatter
+
+
 def get_y_axis_params(metric, plot_type = 'line'):
     if (metric == 'roc_auc' and plot_type == 'line'):
         y_axis_params = dict(range=[0.4, 1], tick0=0.00, dtick=0.05)
@@ -165,6 +516,7 @@ def get_y_axis_params(metric, plot_type = 'line'):
 
 
 # DT Table
+@cached
 def render_mtd_table(protein_name, preselected_confs):
     df_PROT_METADATA = get_data(protein_name, 'df_PROT_METADATA')
 
@@ -174,11 +526,6 @@ def render_mtd_table(protein_name, preselected_confs):
     # df_PROT_METADATA.loc[:,'Date'] = df_PROT_METADATA['Date'].dt.strftime('%m/%d/%Y')
     # df_PROT_METADATA = df_PROT_METADATA.drop(['Pocket Volume (Sec)'], axis=1)
 
-    df_PROT_METADATA.colums = [
-        'PDB id', 'Pub. Date', 'Resolution', 'Coverage',
-        'Ligand', 'Ligand MW', 'Pocket Volume', 'Conformation'
-    ]
-
     # Subset the dataframe
     if preselected_confs is not None:
         X = df_PROT_METADATA.iloc[preselected_confs]
@@ -214,33 +561,71 @@ def render_mtd_table(protein_name, preselected_confs):
 # SCATTER PLOT
 scatter_colors = ['#2a7885', '#5a8b59', '#f64a3b', 'grey', '#fecc6a', '#69d7c4']
 
-def mds_plot(protein_name, dr_method, prot_section, point_size_by, preselected_confs):
-    # Table of protein metadata
-    df_PROT_METADATA = get_data(protein_name, 'df_PROT_METADATA')
-    
+# METADATA JOIN
+# Conformations metadata joined (by PDB id) with the DR coordinates. Built
+# once per data version and extended with the new rows on ingestion.
+def join_metadata(df_PROT_METADATA, df_DIM_REDUCT):
+    X_mtd = pd.concat([df_PROT_METADATA.set_index('PDB-id'),
+                df_DIM_REDUCT], axis=1)
+    X_mtd = X_mtd.reset_index()
+    X_mtd['LigMass'] = pd.to_numeric(X_mtd.LigMass).fillna(0)
+    return freeze_frame(X_mtd)
+
+
+def build_metadata_joins(data):
+    return {key: join_metadata(data[key]['df_PROT_METADATA'], data[key]['df_DIM_REDUCT'])
+            for key in data if isinstance(data[key], dict)}
+
+
+def append_metadata_join(joins, data, protein_key, delta):
+    joins = dict(joins)
+    if 'df_PROT_METADATA' in delta and 'df_DIM_REDUCT' in delta:
+        new_rows = join_metadata(delta['df_PROT_METADATA'], delta['df_DIM_REDUCT'])
+        # Re-compact: categoricals with different categories concat as object
+        joins[protein_key] = freeze_frame(compact_frame(
+            pd.concat([joins[protein_key], new_rows], ignore_index=True),
+            downcast_floats=False))
+    else:
+        joins[protein_key] = join_metadata(data[protein_key]['df_PROT_METADATA'],
+                                           data[protein_key]['df_DIM_REDUCT'])
+    return joins
+
+
+derived_tables['metadata_join'] = build_metadata_joins
+derived_appenders['metadata_join'] = append_metadata_join
+
+def get_metadata_join(protein_name):
+    joins = current_version().derived('metadata_join', build_metadata_joins)
+    return joins[protein_keys[protein_name]]
+
 
-    df_DIM_REDUCT = get_data(protein_name, 'df_DIM_REDUCT')
+def get_dr_job_result(protein_name, prot_section):
+    # None until the job has finished and its result has been published
+    return current_version().get_published(f'job/{dr_jobs[prot_section]}/{protein_name}')
 
-    # Temporal: if pocket volume
-    if prot_section == 'vol_pkt':
+
+@cached
+def mds_plot(protein_name, dr_method, prot_section, point_size_by, preselected_confs,
+             render_mode='auto'):
+    # Temporal: if pocket volume or docking metrics (only cMDS)
+    if prot_section in ('vol_pkt', 'dksc'):
         dr_method = 'mds'
 
-    # Get the dimensions
+    # Get the dimensions from the metadata join (renamed copy: the shared
+    # tables are read-only)
     colname = f'{dr_method}_{prot_section}_'
-    Z = df_DIM_REDUCT[[colname + 'x', colname + 'y']]
-    Z.columns = ['x', 'y']
-
-    # Add the columns to the metadata
-    X_mtd = pd.concat([df_PROT_METADATA.set_index('PDB-id'),
-                Z], axis=1)
-    X_mtd.reset_index(inplace=True)
-    X_mtd.LigMass = pd.to_numeric(X_mtd.LigMass).fillna(0)
+    X_mtd = get_metadata_join(protein_name)
+    if prot_section in dr_jobs:
+        # Embedding published by its background job (callers check it exists)
+        embedding = get_dr_job_result(protein_name, prot_section)
+        X_mtd = X_mtd.join(embedding, on='PDB-id')
+    X_mtd = X_mtd.rename(columns={colname + 'x': 'x', colname + 'y': 'y'})
 
     color_by='Conformation'
     labels_col = X_mtd[color_by]
 
     # Define colors
-    if labels_col.dtype == 'object':
+    if labels_col.dtype.name in ('object', 'category'):
         labels = labels_col.unique()
         
         # Select the number of colors
@@ -251,6 +636,11 @@ def mds_plot(protein_name, dr_method, prot_section, point_size_by, preselected_c
         X_mtd['color_col'] = labels_col.map(color_mapper)
 
 
+    # The same trace type is used for all traces (incl. the 'Selected' ring)
+    # so they are drawn on the same layer
+    n_points = X_mtd.shape[0] + (0 if preselected_confs is None else len(preselected_confs))
+    Scatter = get_scatter_class(n_points, render_mode)
+
     fig = go.Figure()
 
 
@@ -269,7 +659,7 @@ def mds_plot(protein_name, dr_method, prot_section, point_size_by, preselected_c
                 subset.LigMass,
                 subset['Pocket Volume (Pkt)'])]
         fig.add_trace(
-            go.Scatter(
+            Scatter(
                 x = subset.x,
                 y = subset.y,
                 name=label,
@@ -298,7 +688,7 @@ def mds_plot(protein_name, dr_method, prot_section, point_size_by, preselected_c
     if preselected_confs is not None:
         selected = X_mtd.iloc[preselected_confs]
         fig.add_trace(
-            go.Scatter(
+            Scatter(
                 x = selected.x,
                 y = selected.y,
                 name = 'Selected',
@@ -352,7 +742,23 @@ def mds_plot(protein_name, dr_method, prot_section, point_size_by, preselected_c
     return fig
 
 
+def pending_plot(message):
+    # Placeholder while a background job computes the embedding (not cached)
+    fig = go.Figure()
+    fig.update_layout(
+        height=450,
+        template='plotly_white',
+        xaxis=dict(visible=False),
+        yaxis=dict(visible=False),
+        annotations=[dict(text=message, showarrow=False, font=dict(size=16),
+                          xref='paper', yref='paper', x=0.5, y=0.5)],
+        margin=dict(l=30, r=30, t=5, b=30)
+    )
+    return fig
+
+
 # VIOLIN PLOT FUNCTION
+@cached
 def violin_plot_metrics(metric, protein_name, show_benchmarks, preselected_confs):
     if 'bedroc' in metric or 'ef_0' in metric:
         metric_filter = metric.replace('_', '-')
@@ -431,13 +837,155 @@ def violin_plot_metrics(metric, protein_name, show_benchmarks, preselected_confs
 
 
 
+# Curve downsampling
+# Line plot curves are reduced to a point budget set by the plot width, so
+# the payload does not grow with the length of the conformational ensemble
+line_plot_width = 1200  # px
+points_per_px = 0.5
+
+def get_point_budget(plot_width=line_plot_width):
+    return max(int(plot_width * points_per_px), 3)
+
+
+def lttb_indices(x, y, n_out):
+    # Largest-Triangle-Three-Buckets: indices of the n_out points that best
+    # preserve the visual shape of the (x, y) curve. First and last are kept.
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # n_out - 2 buckets between the first and the last point
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    indices = np.empty(n_out, dtype=int)
+    indices[0] = a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # Average point of the next bucket (the last point for the last one)
+        if i + 2 < len(edges):
+            next_x = x[end:edges[i + 2]].mean()
+            next_y = y[end:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[n - 1], y[n - 1]
+        # Keep the point forming the largest triangle with a and the average
+        areas = np.abs((x[a] - next_x) * (y[start:end] - y[a]) -
+                       (x[a] - x[start:end]) * (next_y - y[a]))
+        indices[i + 1] = a = start + np.argmax(areas)
+    indices[-1] = n - 1
+    return indices
+
+
+def downsample_curve(X_mean, X_lower, X_upper, col, n_out, keep_x=None):
+    # Indices shared by the mean curve and its bands: LTTB over the mean,
+    # plus the extrema of the three curves and the k in keep_x
+    mean = X_mean[col].to_numpy(dtype=float)
+    lower = X_lower[col].to_numpy(dtype=float)
+    upper = X_upper[col].to_numpy(dtype=float)
+    if len(mean) <= n_out:
+        return np.arange(len(mean))
+    extrema = [f(curve) for f in (np.nanargmax, np.nanargmin)
+               for curve in (mean, upper, lower)]
+    indices = np.union1d(lttb_indices(np.arange(len(mean)), mean, n_out), extrema)
+    if keep_x is not None:
+        position = X_mean.index.get_indexer([keep_x])
+        indices = np.union1d(indices, position[position >= 0])
+    return indices
+
+
+# BOOTSTRAP BANDS
+# Percentile confidence intervals of the mean score over the repeats of each
+# (split, selector, metric, classifier) and k. The per-repeat scores are
+# optional tables (index: split, selector, metric, repeat, classifier or
+# consensus; columns: k, as in X_ml). The bands are precomputed once per
+# data version; without per-repeat scores the line plot keeps mean ± std.
+band_types = {
+    'std': 'Mean ± std',
+    'ci' : '95% bootstrap CI',
+}
+
+bootstrap_resamples = 1000
+bootstrap_ci = 0.95
+bootstrap_seed = 0
+# Max (series x resamples x k) values of a bootstrap block
+bootstrap_block_size = 2 ** 25
+
+repeats_tables = {'ml': ('dict_ML_RESULTS', 'X_ml_repeats'),
+                  'cs': (None, 'df_CS_REPEATS')}
+
+
+def bootstrap_bands(scores, n_boot=bootstrap_resamples, ci=bootstrap_ci,
+                    seed=bootstrap_seed):
+    # scores: (n_series, n_repeats, n_k) -> lower, upper: (n_series, n_k)
+    # All the series share the same resamples of the repeats: each resample
+    # is a row of weights (counts / n_repeats), so the resampled means of a
+    # block of series are a single (batched) matrix product
+    n_series, n_repeats, n_k = scores.shape
+    rng = np.random.default_rng(seed)
+    resamples = rng.integers(0, n_repeats, size=(n_boot, n_repeats))
+    weights = np.zeros((n_boot, n_repeats), dtype=np.float32)
+    np.add.at(weights, (np.arange(n_boot)[:, None], resamples), 1 / n_repeats)
+
+    alpha = (1 - ci) / 2
+    lower = np.empty((n_series, n_k))
+    upper = np.empty((n_series, n_k))
+    block = max(bootstrap_block_size // (n_boot * n_k), 1)
+    for start in range(0, n_series, block):
+        # (series, k, resamples): the quantiles run over contiguous rows
+        chunk = scores[start:start + block].astype(np.float32)
+        boot_means = np.matmul(chunk.transpose(0, 2, 1), weights.T)
+        lower[start:start + block], upper[start:start + block] = np.quantile(
+            boot_means, [alpha, 1 - alpha], axis=2)
+    return lower, upper
+
+
+def repeats_to_bands(X_rep):
+    # Per-repeat table -> lower/upper tables indexed as the X_ml rows
+    levels = [name for name in X_rep.index.names if name != 'repeat']
+    X_rep = X_rep.reorder_levels(levels + ['repeat']).sort_index()
+    series = X_rep.index.droplevel('repeat').unique()
+    n_repeats = X_rep.index.get_level_values('repeat').nunique()
+    if X_rep.shape[0] != len(series) * n_repeats:
+        raise ValueError('All the series need the same number of repeats')
+    scores = X_rep.to_numpy(dtype=float).reshape(len(series), n_repeats, -1)
+    lower, upper = bootstrap_bands(scores)
+    return {'lower': freeze_frame(pd.DataFrame(lower, index=series, columns=X_rep.columns)),
+            'upper': freeze_frame(pd.DataFrame(upper, index=series, columns=X_rep.columns))}
+
+
+def build_bootstrap_bands(data):
+    bands = {}
+    for key in data:
+        if not isinstance(data[key], dict):
+            continue
+        for methodology, (container, name) in repeats_tables.items():
+            tables = data[key][container] if container else data[key]
+            if name in tables:
+                bands[(key, methodology)] = repeats_to_bands(tables[name])
+    return bands
+
+
+derived_tables['bootstrap_bands'] = build_bootstrap_bands
+# New conformations don't change the results tables
+derived_appenders['bootstrap_bands'] = lambda bands, data, protein_key, delta: bands
+
+def get_bootstrap_bands(protein_name, methodology):
+    # None if there are no per-repeat scores
+    bands = current_version().derived('bootstrap_bands', build_bootstrap_bands)
+    return bands.get((protein_keys[protein_name], methodology))
+
+
 # LINE PLOT FUNCTION
+@cached
 def line_plot_metrics(split, 
                       selector, 
                       metric, 
                       protein_name, 
                       n_confs_sel,
-                      methodology
+                      methodology,
+                      render_mode='auto',
+                      plot_width=line_plot_width,
+                      band='std'
                       ):
 
     query = f"split == '{split}' & selector == '{selector}' & metric == '{metric}'"
@@ -470,55 +1018,78 @@ def line_plot_metrics(split,
     X_mean = X_subset.loc[:, 'mean']
     X_std = X_subset.loc[:, 'std']
 
+    # Shaded bands: mean ± std, or the precomputed bootstrap CI (if there
+    # are per-repeat scores)
+    X_lower, X_upper = X_mean - X_std, X_mean + X_std
+    bands = get_bootstrap_bands(protein_name, methodology) if band == 'ci' else None
+    if bands is not None:
+        X_lower, X_upper = [
+            bands[bound].query(query).reset_index()
+                .drop(['split', 'selector', 'metric', 0], axis=1, errors='ignore')
+                .set_index(classifier).T.loc[X_mean.index, X_mean.columns]
+            for bound in ('lower', 'upper')]
+
     # Número de conformaciones
     n_confs = X_mean.shape[0]
 
     y_axis_params = get_y_axis_params(metric, 'line')
 
+    # Downsample the curves of each classifier to the point budget
+    n_out = get_point_budget(plot_width)
+    curve_indices = {col: downsample_curve(X_mean, X_lower, X_upper, col, n_out, n_confs_sel)
+                     for col in X_mean.columns}
+
+    # Three traces (lower, mean, upper) per classifier
+    n_points = sum(3 * len(indices) for indices in curve_indices.values())
+    Scatter = get_scatter_class(n_points, render_mode)
+
     traces = []
     for col in X_mean.columns:
+        indices = curve_indices[col]
+        x = X_mean.index[indices]
+        mean = X_mean[col].iloc[indices]
+        lower = X_lower[col].iloc[indices]
+        upper = X_upper[col].iloc[indices]
+
         # Create the upper and lower bounds
-        upper = X_mean[col] + X_std[col]
-        lower = X_mean[col] - X_std[col]
-
-        upper = go.Scatter(x=X_mean.index, 
-                           y=X_mean[col] + X_std[col],
-                           mode='lines',
-                           name=clf_names[col], 
-                           legendgroup=clf_names[col], 
-                           showlegend=False,
-                           line=dict(width=0),
-                           fillcolor=cols_fill[col],
-                           hoverinfo='skip',
-                           fill='tonexty')
-
-        line = go.Scatter(x=X_mean.index, 
-                           y=X_mean[col],
-                           mode='lines',
-                           name=clf_names[col],
-                           hovertemplate = 
-                           f'<b style="color: {cols_lines[col]}">{clf_names[col]}</b>' +
-                           '<br>' +
-                           '<b><i>k</i> confs:</b> %{x}' +
-                           '<br>' +
-                           f'<b><i>{metric_names[metric]}</i>:</b> ' + 
-                           '%{y:.2f}' +
-                           '<extra></extra>',
-                           legendgroup=clf_names[col], 
-                           line=dict(width=2.5,
-                                     color=cols_lines[col]),
-                           fillcolor=cols_fill[col],
-                           fill='tonexty')
-
-        lower = go.Scatter(x=X_mean.index, 
-                           y=X_mean[col] - X_std[col],
-                           mode='lines',
-                           name=clf_names[col], 
-                           legendgroup=clf_names[col], 
-                           showlegend=False,
-                           hoverinfo='skip',
-                           line=dict(width=0),
-                          )
+        upper = Scatter(x=x, 
+                        y=upper,
+                        mode='lines',
+                        name=clf_names[col], 
+                        legendgroup=clf_names[col], 
+                        showlegend=False,
+                        line=dict(width=0),
+                        fillcolor=cols_fill[col],
+                        hoverinfo='skip',
+                        fill='tonexty')
+
+        line = Scatter(x=x, 
+                        y=mean,
+                        mode='lines',
+                        name=clf_names[col],
+                        hovertemplate = 
+                        f'<b style="color: {cols_lines[col]}">{clf_names[col]}</b>' +
+                        '<br>' +
+                        '<b><i>k</i> confs:</b> %{x}' +
+                        '<br>' +
+                        f'<b><i>{metric_names[metric]}</i>:</b> ' + 
+                        '%{y:.2f}' +
+                        '<extra></extra>',
+                        legendgroup=clf_names[col], 
+                        line=dict(width=2.5,
+                                  color=cols_lines[col]),
+                        fillcolor=cols_fill[col],
+                        fill='tonexty')
+
+        lower = Scatter(x=x, 
+                        y=lower,
+                        mode='lines',
+                        name=clf_names[col], 
+                        legendgroup=clf_names[col], 
+                        showlegend=False,
+                        hoverinfo='skip',
+                        line=dict(width=0),
+                       )
 
         traces = traces + [lower, line, upper]
 
@@ -588,4 +1159,193 @@ def line_plot_metrics(split,
                         dragmode='pan',
                         margin=dict(l=30, r=30, t=5, b=30),
                         modebar=dict(orientation='v', activecolor='#1d89ff'))
-    return fig
\ No newline at end of file
+    return fig
+
+
+# MULTI-TARGET COMPARISON
+# The figure of each target is built (or read from the cache) in its own
+# worker thread, pinned to the data version of the calling request
+comparison_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('COMPARISON_WORKERS', 4)),
+    thread_name_prefix='comparison')
+
+def comparison_figures(split, selector, metric, protein_names, n_confs_sel, methodology,
+                       band='std'):
+    version = current_version()
+
+    def build(protein_name):
+        with use_data_version(version):
+            return line_plot_metrics(split, selector, metric, protein_name,
+                                     n_confs_sel, methodology, band=band)
+
+    return list(comparison_executor.map(build, protein_names))
+
+
+# SUMMARY TABLE
+# Peak mean score, k at the peak and gain over the Dksc references of every
+# split x selector x metric x classifier/consensus combination
+summary_values = {
+    'gain_best'  : 'Gain over max Dksc',
+    'gain_median': 'Gain over med Dksc',
+    'peak'       : 'Peak mean score',
+}
+
+def results_summary(X, X_dksc, classifier):
+    keys = ['split', 'selector', 'metric']
+    X = X.reset_index().drop(columns=[0], errors='ignore')
+    X = X.set_index(keys + ['desc', classifier])
+    means = X.xs('mean', level='desc')
+
+    # One vectorized pass over all the curves
+    values = means.to_numpy(dtype=float)
+    summary = means.index.to_frame(index=False).rename(columns={classifier: 'method'})
+    # Curves without any value (e.g. a missing metric or classifier) have
+    # no peak: NaN instead of an error
+    has_values = ~np.isnan(values).all(axis=1)
+    peak_index = np.nanargmax(values[has_values], axis=1)
+    summary['peak'] = np.nan
+    summary['k_peak'] = np.nan
+    summary.loc[has_values, 'peak'] = values[has_values][np.arange(len(peak_index)), peak_index]
+    summary.loc[has_values, 'k_peak'] = np.asarray(means.columns, dtype=float)[peak_index]
+
+    # Same references as in line_plot_metrics
+    refs = X_dksc.groupby(keys, observed=True).agg(
+        best_dksc=('best_dksc', 'max'), median_dksc=('median_dksc', 'median'))
+    summary = summary.merge(refs.reset_index(), on=keys, how='left')
+    summary['gain_best'] = summary.peak - summary.best_dksc
+    summary['gain_median'] = summary.peak - summary.median_dksc
+    return summary
+
+
+def build_summary_table(data):
+    tables = []
+    for protein_name, key in protein_keys.items():
+        dict_ML_RESULTS = data[key]['dict_ML_RESULTS']
+        X_dksc = dict_ML_RESULTS['X_dksc']
+        for methodology, X, classifier in [
+                ('ml', dict_ML_RESULTS['X_ml'], 'classifier'),
+                ('cs', data[key]['df_CS_RESULTS'], 'consensus')]:
+            summary = results_summary(X, X_dksc, classifier)
+            summary.insert(0, 'methodology', methodology)
+            summary.insert(0, 'protein', protein_name)
+            tables.append(summary)
+    return pd.concat(tables, ignore_index=True)
+
+
+derived_tables['summary'] = build_summary_table
+# New conformations don't change the results tables
+derived_appenders['summary'] = lambda summary, data, protein_key, delta: summary
+precompute_derived(DATA_VERSION)
+
+
+def get_summary(protein_name, methodology):
+    summary = current_version().derived('summary', build_summary_table)
+    return summary[(summary.protein == protein_name) &
+                   (summary.methodology == methodology)]
+
+
+@cached
+def summary_heatmap(protein_name, methodology, value='gain_best'):
+    summary = get_summary(protein_name, methodology)
+    method_names = clf_names_dict if methodology == 'ml' else cs_names_dict
+
+    # Rows: split / selector; columns: metric / method (in the app's order)
+    rows = [(split, selector) for split in split_names for selector in selector_names]
+    cols = [(metric, method) for metric in metric_names for method in method_names]
+    grid = summary.set_index(['split', 'selector', 'metric', 'method'])
+    grid = grid.reindex([row + col for row in rows for col in cols])
+    shape = (len(rows), len(cols))
+
+    customdata = np.dstack([grid[name].to_numpy(dtype=float).reshape(shape)
+        for name in ['peak', 'k_peak', 'gain_best', 'gain_median']])
+
+    is_gain = value != 'peak'
+    fig = go.Figure(
+        go.Heatmap(
+            z=grid[value].to_numpy(dtype=float).reshape(shape),
+            x=[f'{metric_names[metric]}<br>{method_names[method]}' for metric, method in cols],
+            y=[f'{split_names[split]} / {selector_names[selector]}' for split, selector in rows],
+            customdata=customdata,
+            colorscale='RdBu' if is_gain else 'Viridis',
+            zmid=0 if is_gain else None,
+            colorbar=dict(title=summary_values[value]),
+            hovertemplate=
+                '<b>%{y}</b><br>%{x}' +
+                '<br><b>Peak:</b> %{customdata[0]:.2f} at <b><i>k</i></b> = %{customdata[1]}' +
+                '<br><b>Gain vs max Dksc:</b> %{customdata[2]:.2f}' +
+                '<br><b>Gain vs med Dksc:</b> %{customdata[3]:.2f}' +
+                '<extra></extra>'
+        )
+    )
+    fig.update_xaxes(tickangle=-45, showline=True, linewidth=2.5, linecolor='#43494F', mirror=True)
+    fig.update_yaxes(autorange='reversed', showline=True, linewidth=2.5,
+                     linecolor='black', mirror=True)
+    fig.update_layout(
+        height=450,
+        template='plotly_white',
+        hoverlabel=dict(
+            bgcolor = 'white',
+            font_size=14
+        ),
+        margin=dict(l=30, r=30, t=5, b=30),
+        modebar=dict(orientation='v', activecolor='#1d89ff')
+    )
+    return fig
+
+
+def check_immutability():
+    # Build every figure/table once and verify the shared data is unchanged
+    import itertools
+    version = current_version()
+    data = version.data
+    before = data_fingerprint(data)
+    # Stub embeddings for the DR sections computed by background jobs
+    for protein_name, (prot_section, task) in itertools.product(mos_info, dr_jobs.items()):
+        pdb_ids = get_data(protein_name, 'df_DKSC_METRICS').index
+        version.publish(f'job/{task}/{protein_name}', pd.DataFrame(
+            0.0, index=pd.Index(pdb_ids, name='PDB-id'),
+            columns=[f'mds_{prot_section}_x', f'mds_{prot_section}_y']))
+    for protein_name, methodology, split, selector, metric in itertools.product(
+            mos_info, methodologies_dic, split_names, selector_names, metric_names):
+        preselected_confs = get_preselected_confs(split, selector, 50, protein_name)
+        line_plot_metrics(split, selector, metric, protein_name, 50, methodology)
+        violin_plot_metrics(metric, protein_name, [], preselected_confs)
+        render_mtd_table(protein_name, preselected_confs)
+        for dr_method, prot_section in itertools.product(dr_methods_names, prot_section_dr):
+            mds_plot(protein_name, dr_method, prot_section, 'LigMass', preselected_confs)
+    after = data_fingerprint(data)
+    changed = [key for key in before if before[key] != after[key]]
+    assert len(changed) == 0, f'Shared tables mutated: {changed}'
+
+    # The tables are still read-only once every figure has been built (the
+    # same value is written back, so a missed write changes nothing)
+    def writable_columns(data, prefix=''):
+        for key, value in data.items():
+            if isinstance(value, dict):
+                yield from writable_columns(value, f'{prefix}{key}/')
+            elif isinstance(value, pd.DataFrame) and value.shape[0] > 0:
+                for j in range(value.shape[1]):
+                    try:
+                        value.iloc[0, j] = value.iloc[0, j]
+                    except ValueError:
+                        continue
+                    yield f'{prefix}{key}[{value.columns[j]}]'
+    writable = list(writable_columns(data))
+    assert len(writable) == 0, f'Writable shared columns: {writable[:10]}'
+    print('OK: no table was mutated')
+
+
+if __name__ == '__main__':
+    import sys
+    if '--check' in sys.argv:
+        check_immutability()
+
+    # Memory report: raw pickle vs compacted tables
+    with open(app_data, 'rb') as f:
+        raw_report = memory_report(pickle.load(f))
+    report = raw_report.merge(memory_report(APP_DATA)[['table', 'bytes']],
+                              on='table', suffixes=('_raw', '_compact'))
+    report['saved (%)'] = 100 * (1 - report.bytes_compact / report.bytes_raw)
+    print(report.round(1).to_string(index=False))
+    print('Total: {:.2f} MB -> {:.2f} MB'.format(
+        report.bytes_raw.sum() / 2**20, report.bytes_compact.sum() / 2**20))
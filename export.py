@@ -0,0 +1,204 @@
+import itertools
+import zlib
+
+import flask
+import numpy as np
+import pandas as pd
+
+from data_source import (get_data, get_preselected_confs, mos_info, split_names,
+                         selector_names, metric_names)
+
+
+# BULK EXPORT API
+# /export/<table>.<csv|parquet>?protein=CDK2&split=rand&selector=LR&metric=roc_auc&k=50
+# Output is written and sent chunk by chunk (gzip CSV or Parquet row groups)
+# so a full export never builds the whole file in memory: the filters are
+# applied to each chunk of the shared tables, not to a copy of them.
+# protein=all exports every target, with the target as first index level
+# (the tables need the same columns: set k for ml_results / cs_results).
+export_api = flask.Blueprint('export', __name__)
+
+chunk_rows = 2000
+
+export_tables = {
+    'ml_results'    : 'Machine Learning results (X_ml)',
+    'cs_results'    : 'Consensus Scoring results (df_CS_RESULTS)',
+    'dksc_metrics'  : 'Docking scores metrics per conformation (df_DKSC_METRICS)',
+    'metadata'      : 'Protein conformations metadata (df_PROT_METADATA)',
+    'selected_confs': 'Metadata of the RFE selected conformations (first k)',
+}
+
+
+class BadRequest(Exception):
+    pass
+
+
+def get_param(name, options, default=None):
+    value = flask.request.args.get(name, default)
+    if value is not None and value not in options:
+        raise BadRequest(f'Invalid {name}: {value}. Options: {", ".join(options)}')
+    return value
+
+
+def get_k():
+    k = flask.request.args.get('k')
+    if k is None:
+        return None
+    if not k.isdigit() or int(k) < 1:
+        raise BadRequest(f'Invalid k: {k}')
+    return int(k)
+
+
+def filter_results(X, split, selector, metric, k):
+    # Vectorized mask over the (split, selector, metric) index levels
+    mask = np.ones(X.shape[0], dtype=bool)
+    for level, value in [('split', split), ('selector', selector), ('metric', metric)]:
+        if value is not None:
+            mask &= X.index.get_level_values(level) == value
+    X = X[mask]
+    if k is not None:
+        X = X[[k]]
+    return X
+
+
+def get_export_frame(table, protein_name, split, selector, metric, k):
+    # The shared table of a target and the selection applied to each chunk
+    if table in ('ml_results', 'cs_results'):
+        if table == 'ml_results':
+            X = get_data(protein_name, 'dict_ML_RESULTS')['X_ml']
+        else:
+            X = get_data(protein_name, 'df_CS_RESULTS')
+        if k is not None and k not in X.columns:
+            raise BadRequest(f'k out of range for {protein_name}: {k}')
+        return X, lambda chunk: filter_results(chunk, split, selector, metric, k)
+    elif table == 'dksc_metrics':
+        X = get_data(protein_name, 'df_DKSC_METRICS')
+        if metric is None:
+            return X, lambda chunk: chunk
+        # Same column naming as in violin_plot_metrics
+        if 'bedroc' in metric or 'ef_0' in metric:
+            metric = metric.replace('_', '-')
+        columns = [col for col in X.columns if col.endswith(f'_{metric}')]
+        return X, lambda chunk: chunk[columns]
+    elif table == 'metadata':
+        return get_data(protein_name, 'df_PROT_METADATA'), lambda chunk: chunk
+    elif table == 'selected_confs':
+        if selector in (None, 'rand') or split is None or k is None:
+            raise BadRequest('selected_confs needs split, selector (not rand) and k')
+        preselected_confs = get_preselected_confs(split, selector, k, protein_name)
+        X = get_data(protein_name, 'df_PROT_METADATA').iloc[preselected_confs]
+        return X, lambda chunk: chunk
+    raise BadRequest(f'Unknown table: {table}. Options: {", ".join(export_tables)}')
+
+
+def get_export_chunks(table):
+    protein = get_param('protein', list(mos_info) + ['all'], 'CDK2')
+    split = get_param('split', split_names)
+    selector = get_param('selector', selector_names)
+    metric = get_param('metric', metric_names)
+    k = get_k()
+
+    protein_names = list(mos_info) if protein == 'all' else [protein]
+    frames = [(protein_name, *get_export_frame(table, protein_name, split, selector, metric, k))
+              for protein_name in protein_names]
+    if protein == 'all':
+        columns = {tuple(select(X.iloc[:0]).columns) for _, X, select in frames}
+        if len(columns) > 1:
+            raise BadRequest(f'{table} has different columns for each target: '
+                             'export one protein (or set k)')
+
+    def chunks():
+        for protein_name, X, select in frames:
+            for start in range(0, max(X.shape[0], 1), chunk_rows):
+                chunk = select(X.iloc[start:start + chunk_rows])
+                if protein == 'all':
+                    chunk = pd.concat({protein_name: chunk}, names=['protein'])
+                yield chunk
+
+    return chunks()
+
+
+def stream_csv(chunks):
+    # gzip stream: each chunk is compressed as soon as it is written
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for i, chunk in enumerate(chunks):
+        yield compressor.compress(chunk.to_csv(header=i == 0).encode())
+    yield compressor.flush()
+
+
+class ChunkSink:
+    # File-like object collecting the bytes written by the Parquet writer
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_parquet(chunks):
+    # Imported here: pyarrow is only loaded by the workers that export Parquet
+    # (and an import error is raised before the response starts)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Parquet needs string column names (X_ml columns are the k values)
+    first = next(chunks).rename(columns=str)
+    # One schema for every chunk, from the first one (before the response
+    # starts). Columns without values there are strings: inferred per chunk,
+    # a column could be null in one chunk and string in the next.
+    schema = pa.Schema.from_pandas(first, preserve_index=True)
+    schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type)
+                        else field for field in schema], metadata=schema.metadata)
+
+    def write_chunks():
+        sink = ChunkSink()
+        writer = pq.ParquetWriter(sink, schema, compression='snappy')
+        for chunk in itertools.chain([first], (chunk.rename(columns=str) for chunk in chunks)):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema,
+                                                    preserve_index=True))
+            yield sink.drain()
+        writer.close()
+        yield sink.drain()
+
+    return write_chunks()
+
+
+@export_api.route('/export/<table>.<fmt>')
+def export(table, fmt):
+    try:
+        if fmt not in ('csv', 'parquet'):
+            raise BadRequest(f'Invalid format: {fmt}. Options: csv, parquet')
+        chunks = get_export_chunks(table)
+    except BadRequest as e:
+        return flask.jsonify(error=str(e)), 400
+
+    if fmt == 'csv':
+        body, mimetype, filename = stream_csv(chunks), 'application/gzip', f'{table}.csv.gz'
+    else:
+        body, mimetype, filename = stream_parquet(chunks), 'application/octet-stream', f'{table}.parquet'
+
+    response = flask.Response(body, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    # Already compressed and streamed: keep response compression middleware out
+    response.direct_passthrough = True
+    return response
+
+
+@export_api.route('/export')
+def export_index():
+    return flask.jsonify(tables=export_tables, formats=['csv', 'parquet'],
+                         filters=['protein', 'split', 'selector', 'metric', 'k'],
+                         proteins=list(mos_info) + ['all'])
@@ -0,0 +1,249 @@
+'''
+Incremental ingestion of new protein conformations.
+
+    python ingest.py CDK2 new_confs.pkl
+    python ingest.py CDK2 --compact
+    python ingest.py --check
+
+new_confs.pkl is a dict with the new rows of df_PROT_METADATA and
+df_DIM_REDUCT (and optionally df_DKSC_METRICS), same columns as the loaded
+tables. The rows are stored as a delta segment (see data_source: DELTA
+SEGMENTS): the cost of an ingestion depends on the size of the delta, not on
+the size of the ensemble. Running servers pick the segment up on their next
+data check. Segments are merged into the data file in the background once
+there are `compact_after` of them.
+'''
+import argparse
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+
+import pandas as pd
+
+import data_source
+from data_source import (app_data, conformation_tables, list_segments,
+                         load_app_data, protein_keys, read_segment)
+
+compact_after = int(os.environ.get('DATA_COMPACT_AFTER', 8))
+
+
+class IngestError(Exception):
+    pass
+
+
+def validate_delta(protein_name, delta):
+    # Same columns as the loaded tables, new and consistent PDB ids
+    if protein_name not in protein_keys:
+        raise IngestError(f'Unknown protein: {protein_name}')
+    unknown = set(delta) - set(conformation_tables)
+    if unknown:
+        raise IngestError(f'Unknown tables: {sorted(unknown)}')
+    for key in ['df_PROT_METADATA', 'df_DIM_REDUCT']:
+        if key not in delta:
+            raise IngestError(f'Missing table: {key}')
+
+    checked = {}
+    for key, table in delta.items():
+        current = data_source.get_data(protein_name, key)
+        missing = set(current.columns) - set(table.columns)
+        extra = set(table.columns) - set(current.columns)
+        if missing or extra:
+            raise IngestError(f'{key}: missing columns {sorted(missing, key=str)}, '
+                              f'unexpected columns {sorted(extra, key=str)}')
+        # Same index name too: the metadata join needs 'PDB-id'
+        checked[key] = table[list(current.columns)].rename_axis(current.index.name)
+
+    n_rows = {key: table.shape[0] for key, table in checked.items()}
+    if len(set(n_rows.values())) != 1:
+        raise IngestError(f'Tables with different number of rows: {n_rows}')
+
+    pdb_ids = pd.Index(checked['df_PROT_METADATA']['PDB-id'])
+    if not pdb_ids.is_unique:
+        raise IngestError('Duplicated PDB ids in the new conformations')
+    if not pdb_ids.equals(pd.Index(checked['df_DIM_REDUCT'].index)):
+        raise IngestError('df_DIM_REDUCT must be indexed by the same PDB ids, in order')
+    current_ids = data_source.get_data(protein_name, 'df_PROT_METADATA')['PDB-id']
+    existing = pdb_ids.intersection(pd.Index(current_ids))
+    if len(existing) > 0:
+        raise IngestError(f'Conformations already loaded: {list(existing)}')
+    return checked
+
+
+def write_atomic(path, obj):
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return tmp_path
+
+
+# Last segment merged into the data file, kept next to the segments: the
+# merged segment files are deleted, but their sequence numbers must not be
+# reused (readers skip every segment up to the merged one)
+def merged_mark_path(protein_key):
+    return os.path.join(data_source.segments_dir, protein_key, 'merged')
+
+
+def read_merged_mark(protein_key):
+    try:
+        with open(merged_mark_path(protein_key)) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 0
+
+
+def write_merged_mark(protein_key, seq):
+    tmp_path = merged_mark_path(protein_key) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(str(seq))
+    os.replace(tmp_path, merged_mark_path(protein_key))
+
+
+def write_segment(protein_key, delta):
+    # Next sequence number; os.link fails if another process took it first
+    directory = os.path.join(data_source.segments_dir, protein_key)
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = write_atomic(os.path.join(directory, 'segment'), delta)
+    try:
+        while True:
+            segments = list_segments(protein_key)
+            last = segments[-1][0] if segments else 0
+            seq = max(last, read_merged_mark(protein_key)) + 1
+            path = os.path.join(directory, f'{seq:06d}.pkl')
+            try:
+                os.link(tmp_path, path)
+                return seq, path
+            except FileExistsError:
+                continue
+    finally:
+        os.remove(tmp_path)
+
+
+def ingest_conformations(protein_name, delta, background=True):
+    delta = validate_delta(protein_name, delta)
+    protein_key = protein_keys[protein_name]
+    seq, path = write_segment(protein_key, delta)
+
+    # This process sees the new rows right away; other workers on their
+    # next data check
+    data_source.reload_if_changed()
+
+    if len(list_segments(protein_key)) >= compact_after:
+        if background:
+            threading.Thread(target=compact_segments, name='segments-compaction',
+                             daemon=True).start()
+        else:
+            compact_segments()
+    return seq
+
+
+def compact_segments(path=app_data):
+    # Merge the segments into the data file. The file records the last merged
+    # segment of each protein, so readers never apply a segment twice.
+    lock_path = os.path.join(data_source.segments_dir, 'compaction.lock')
+    os.makedirs(data_source.segments_dir, exist_ok=True)
+    try:
+        lock = os.open(lock_path, os.O_CREAT | os.O_EXCL)
+    except FileExistsError:
+        return False  # Another compaction is running
+    try:
+        with open(path, 'rb') as f:
+            raw = pickle.load(f)
+        merged = dict(raw.get('merged_segments', {}))
+        merged_paths = []
+        for protein_key in raw:
+            if not isinstance(raw[protein_key], dict):
+                continue
+            for seq, segment in list_segments(protein_key, merged.get(protein_key, 0)):
+                delta = read_segment(segment)
+                for key, table in delta.items():
+                    raw[protein_key][key] = pd.concat([raw[protein_key][key], table])
+                merged[protein_key] = seq
+                merged_paths.append(segment)
+        if len(merged_paths) == 0:
+            return False
+        raw['merged_segments'] = merged
+        os.replace(write_atomic(path, raw), path)
+        # Marks first: the segment files keep the sequence numbers until then
+        for protein_key, seq in merged.items():
+            write_merged_mark(protein_key, max(seq, read_merged_mark(protein_key)))
+        for segment in merged_paths:
+            os.remove(segment)
+        return True
+    finally:
+        os.close(lock)
+        os.remove(lock_path)
+
+
+def check_ingestion():
+    # Ingest, compact and ingest again on a copy of the data file (and a
+    # temporary segments dir): no conformation may be lost, and all of them
+    # are plotted
+    protein_name = 'CDK2'
+    protein_key = protein_keys[protein_name]
+    metadata = data_source.get_data(protein_name, 'df_PROT_METADATA')
+    dim_reduct = data_source.get_data(protein_name, 'df_DIM_REDUCT')
+
+    def new_delta(pdb_id):
+        rows = metadata.tail(1).copy()
+        rows['PDB-id'] = pdb_id
+        return validate_delta(protein_name, {
+            'df_PROT_METADATA': rows,
+            'df_DIM_REDUCT': dim_reduct.tail(1).set_axis([pdb_id], axis=0)})
+
+    segments_dir = data_source.segments_dir
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_source.segments_dir = os.path.join(tmp_dir, 'segments')
+        path = os.path.join(tmp_dir, 'data.pkl')
+        shutil.copy(app_data, path)
+        try:
+            seqs = [write_segment(protein_key, new_delta(pdb_id))[0]
+                    for pdb_id in ['CHK001', 'CHK002']]
+            assert compact_segments(path), 'Nothing compacted'
+            seqs.append(write_segment(protein_key, new_delta('CHK003'))[0])
+            assert seqs == [1, 2, 3], f'Sequence numbers reused: {seqs}'
+
+            data, applied = load_app_data(path)
+            pdb_ids = set(data[protein_key]['df_PROT_METADATA']['PDB-id'])
+            missing = {'CHK001', 'CHK002', 'CHK003'} - pdb_ids
+            assert len(missing) == 0, f'Conformations lost: {sorted(missing)}'
+            assert applied[protein_key] == 3
+
+            # The new conformations are plotted (from the rebuilt join)
+            version = data_source.DataVersion(data, None, applied)
+            with data_source.use_data_version(version):
+                fig = data_source.mds_plot.__wrapped__(protein_name, 'mds', 'sec',
+                                                       'LigMass', None)
+            plotted = ' '.join(text for trace in fig.data for text in trace.hovertext)
+            missing = [pdb_id for pdb_id in ['CHK001', 'CHK002', 'CHK003']
+                       if f'<b>Conf:</b> {pdb_id}<' not in plotted]
+            assert len(missing) == 0, f'Conformations not plotted: {missing}'
+        finally:
+            data_source.segments_dir = segments_dir
+    print('OK: no conformation lost after compaction')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('protein', nargs='?', choices=list(protein_keys))
+    parser.add_argument('delta', nargs='?', help='pickle with the new rows')
+    parser.add_argument('--compact', action='store_true',
+                        help='merge the segments into the data file')
+    parser.add_argument('--check', action='store_true',
+                        help='ingest after a compaction on a copy of the data')
+    args = parser.parse_args()
+
+    if args.check:
+        check_ingestion()
+    elif args.delta and args.protein is None:
+        parser.error('the protein is required')
+
+    if args.delta:
+        with open(args.delta, 'rb') as f:
+            seq = ingest_conformations(args.protein, pickle.load(f), background=False)
+        print(f'{args.protein}: segment {seq} written')
+    if args.compact:
+        print('Compacted' if compact_segments() else 'Nothing to compact')
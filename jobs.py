@@ -0,0 +1,244 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pandas as pd
+
+import data_source
+
+
+# BACKGROUND JOBS
+# Long recomputations run in a process pool instead of a gunicorn worker
+# thread. Each job has a JSON record (status, progress) and, when done, a
+# pickled result in the jobs directory, so any web worker can poll it. The
+# result is then published into the data version it was computed from.
+jobs_dir = os.environ.get('JOBS_DIR', './jobs')
+job_workers = int(os.environ.get('JOB_WORKERS', 1))
+# A running job writes its record at least every job_heartbeat seconds; a
+# queued job belongs to the web worker that submitted it. Jobs whose worker
+# is gone are reported as failed (and submitted again).
+job_heartbeat = 5
+job_stale_after = int(os.environ.get('JOB_STALE_AFTER', 60))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=job_workers)
+        return _executor
+
+
+def reset_executor(executor):
+    # A pool process died (e.g. killed by the OOM killer): the pool is broken
+    # and a new one is created on the next submit
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+
+def record_path(job_id):
+    return os.path.join(jobs_dir, f'{job_id}.json')
+
+
+def result_path(job_id):
+    return os.path.join(jobs_dir, f'{job_id}.pkl')
+
+
+def write_record(job_id, **fields):
+    # Atomic update of the job record (read by other processes)
+    record = read_record(job_id) or {}
+    record.update(fields, updated=time.time())
+    tmp_path = record_path(job_id) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(record, f)
+    os.replace(tmp_path, record_path(job_id))
+
+
+def read_record(job_id):
+    try:
+        with open(record_path(job_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def process_alive(pid):
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def is_stale(record):
+    if record['status'] == 'running':
+        return time.time() - record['updated'] > job_stale_after
+    if record['status'] == 'queued':
+        return not process_alive(record.get('owner'))
+    return False
+
+
+def read_job(job_id):
+    # The job record, with the jobs lost by their worker reported as failed
+    record = read_record(job_id)
+    if record is not None and is_stale(record):
+        record.update(status='failed', message='Job lost: its worker stopped')
+    return record
+
+
+def run_job(job_id, task, params):
+    # Runs in the worker process
+    lock = threading.Lock()
+    stopped = threading.Event()
+
+    def progress(fraction, message):
+        with lock:
+            write_record(job_id, status='running', progress=fraction, message=message)
+
+    def heartbeat():
+        while not stopped.wait(job_heartbeat):
+            with lock:
+                write_record(job_id)
+
+    progress(0, 'Started')
+    threading.Thread(target=heartbeat, name='job-heartbeat', daemon=True).start()
+    try:
+        result = job_tasks[task](progress, **params)
+        tmp_path = result_path(job_id) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(result, f)
+        os.replace(tmp_path, result_path(job_id))
+        stopped.set()
+        with lock:
+            write_record(job_id, status='done', progress=1, message='Done')
+    except Exception as e:
+        stopped.set()
+        with lock:
+            write_record(job_id, status='failed', message=f'{type(e).__name__}: {e}')
+        raise
+
+
+def job_finished(job_id, executor, future):
+    # Done callback (in the web worker): a job that ended without writing its
+    # final status, e.g. because its pool process died, is marked as failed
+    error = future.exception()
+    if error is None:
+        return
+    if isinstance(error, BrokenProcessPool):
+        reset_executor(executor)
+    record = read_record(job_id)
+    if record is not None and record['status'] in ('queued', 'running'):
+        write_record(job_id, status='failed', message=f'{type(error).__name__}: {error}')
+
+
+def job_key(task, protein_name, version):
+    return f'{task}|{protein_name}|{version}'
+
+
+def job_id_for(key):
+    # Same id in every worker (and after a restart) for the same computation
+    return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+
+def submit_job(task, protein_name, **params):
+    # Returns the job id right away; a job queued, running or done for the
+    # same task, protein and data version is reused
+    version = data_source.current_version()
+    key = job_key(task, protein_name, version.version)
+    job_id = job_id_for(key)
+    with _executor_lock:
+        record = read_job(job_id)
+        if record is not None and record['status'] != 'failed':
+            return job_id
+        os.makedirs(jobs_dir, exist_ok=True)
+        write_record(job_id, id=job_id, task=task, key=key, status='queued',
+                     progress=0, message='Queued', owner=os.getpid(),
+                     created=time.time())
+    # Inputs are taken from the current data version in this process
+    inputs = job_inputs[task](protein_name, **params)
+    executor = get_executor()
+    try:
+        future = executor.submit(run_job, job_id, task, inputs)
+    except BrokenProcessPool:
+        reset_executor(executor)
+        executor = get_executor()
+        future = executor.submit(run_job, job_id, task, inputs)
+    future.add_done_callback(lambda future: job_finished(job_id, executor, future))
+    return job_id
+
+
+def current_job(task, protein_name):
+    # Record of the job for the current data version (None if not submitted)
+    version = data_source.current_version()
+    return read_job(job_id_for(job_key(task, protein_name, version.version)))
+
+
+def job_result(task, protein_name):
+    # Result for the current data version: from the version itself, or
+    # published from the jobs directory when a job has finished
+    version = data_source.current_version()
+    name = f'job/{task}/{protein_name}'
+    result = version.get_published(name)
+    if result is None:
+        job_id = job_id_for(job_key(task, protein_name, version.version))
+        record = read_record(job_id)
+        if record is not None and record['status'] == 'done':
+            with open(result_path(job_id), 'rb') as f:
+                result = pickle.load(f)
+            version.publish(name, result)
+    return result
+
+
+# TASKS
+# Classical MDS of the conformations described by their docking-metric
+# profile (all the columns of df_DKSC_METRICS)
+def cmds_dksc_inputs(protein_name):
+    # Rows are identified by the df_DKSC_METRICS index (PDB ids): new
+    # conformations may be ingested without docking metrics. Incomplete
+    # profiles are left out (no coordinates in the plot).
+    df_DKSC_METRICS = data_source.get_data(protein_name, 'df_DKSC_METRICS').dropna()
+    return dict(profiles=df_DKSC_METRICS.to_numpy(dtype=float),
+                pdb_ids=df_DKSC_METRICS.index.tolist())
+
+
+def cmds_dksc(progress, profiles, pdb_ids):
+    progress(0.1, 'Standardizing profiles')
+    std = profiles.std(axis=0)
+    X = (profiles - profiles.mean(axis=0)) / np.where(std > 0, std, 1)
+
+    progress(0.3, 'Pairwise distances')
+    sq_norms = (X ** 2).sum(axis=1)
+    D2 = np.maximum(sq_norms[:, None] + sq_norms[None, :] - 2 * X @ X.T, 0)
+
+    progress(0.6, 'Double centering')
+    n = D2.shape[0]
+    J = np.eye(n) - np.ones((n, n)) / n
+    B = -0.5 * J @ D2 @ J
+
+    progress(0.8, 'Eigendecomposition')
+    eigvals, eigvecs = np.linalg.eigh(B)
+    top = np.argsort(eigvals)[::-1][:2]
+    Z = eigvecs[:, top] * np.sqrt(np.maximum(eigvals[top], 0))
+
+    return pd.DataFrame(Z, columns=['mds_dksc_x', 'mds_dksc_y'],
+                        index=pd.Index(pdb_ids, name='PDB-id'))
+
+
+job_tasks = {'cmds_dksc': cmds_dksc}
+job_inputs = {'cmds_dksc': cmds_dksc_inputs}
@@ -0,0 +1,223 @@
+'''
+Local load test: replays Dash callback requests (`_dash-update-component`)
+with N concurrent clients against a gunicorn server started on localhost.
+
+    python loadtest.py --clients 8 --duration 30 --workers 2
+    python loadtest.py --clients 8 --worker-class gthread --threads 4
+    python loadtest.py --url http://127.0.0.1:8050   # already running server
+
+Everything runs offline: the callback graph and the default control values
+are read from the server itself (`_dash-dependencies`, `_dash-layout`).
+'''
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+import numpy as np
+
+# User sessions replayed by every client
+SCENARIOS = ['protein_switch', 'slider_burst', 'metric_change', 'selector_change']
+N_CONFS_MAX = {'CDK2': 402, 'FXa': 136}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, workers, worker_class, threads):
+    cmd = ['gunicorn', 'app:server',
+           '--bind', f'127.0.0.1:{port}',
+           '--workers', str(workers),
+           '--worker-class', worker_class,
+           '--threads', str(threads),
+           '--log-level', 'warning']
+    server = subprocess.Popen(cmd, cwd=os.path.dirname(os.path.abspath(__file__)))
+    # Wait until the app answers (data loading happens at import)
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if server.poll() is not None:
+            sys.exit(f'gunicorn exited with code {server.returncode}')
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/_dash-layout')
+            if conn.getresponse().status == 200:
+                return server
+        except OSError:
+            time.sleep(0.5)
+    server.terminate()
+    sys.exit('Timeout waiting for the server to start')
+
+
+def get_json(host, port, path):
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    conn.request('GET', path)
+    response = conn.getresponse()
+    return json.loads(response.read())
+
+
+def layout_values(node, values=None):
+    # Collect {'id.property': value} of every component in the layout
+    if values is None:
+        values = {}
+    if isinstance(node, list):
+        for child in node:
+            layout_values(child, values)
+    elif isinstance(node, dict):
+        props = node.get('props', {})
+        if 'id' in props:
+            for prop, value in props.items():
+                values[f"{props['id']}.{prop}"] = value
+        layout_values(props.get('children'), values)
+    return values
+
+
+def callback_name(output):
+    # '..line-plot.figure...violin-plot.figure..' -> 'line-plot+violin-plot'
+    ids = dict.fromkeys(o.split('.')[0] for o in output.strip('.').split('...'))
+    return '+'.join(ids)
+
+
+class Client(threading.Thread):
+    def __init__(self, host, port, callbacks, defaults, deadline, seed, results):
+        super().__init__(daemon=True)
+        self.conn = http.client.HTTPConnection(host, port, timeout=60)
+        self.callbacks = callbacks
+        self.state = dict(defaults)
+        self.deadline = deadline
+        self.rng = random.Random(seed)
+        # One browser tab per client
+        if 'session-id.data' in self.state:
+            self.state['session-id.data'] = f'loadtest-{seed}'
+        self.results = results
+
+    def fire(self, changed):
+        # Fire every callback triggered by the changed props, as the renderer does
+        for cb in self.callbacks:
+            inputs = [f"{i['id']}.{i['property']}" for i in cb['inputs']]
+            if not any(prop in inputs for prop in changed):
+                continue
+            body = dict(
+                output=cb['output'],
+                inputs=[dict(id=i['id'], property=i['property'],
+                             value=self.state.get(f"{i['id']}.{i['property']}"))
+                        for i in cb['inputs']],
+                state=[dict(id=s['id'], property=s['property'],
+                            value=self.state.get(f"{s['id']}.{s['property']}"))
+                       for s in cb['state']],
+                changedPropIds=[p for p in changed if p in inputs]
+            )
+            self.post(callback_name(cb['output']), body)
+
+    def post(self, name, body):
+        start = time.perf_counter()
+        ok = False
+        try:
+            self.conn.request('POST', '/_dash-update-component',
+                              body=json.dumps(body),
+                              headers={'Content-Type': 'application/json'})
+            response = self.conn.getresponse()
+            response.read()
+            ok = response.status in (200, 204)
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+        self.results.append((name, time.perf_counter() - start, ok))
+
+    def run(self):
+        while time.time() < self.deadline:
+            getattr(self, self.rng.choice(SCENARIOS))()
+
+    # Scenarios
+    def protein_switch(self):
+        protein = 'FXa' if self.state.get('protein-value.value') == 'CDK2' else 'CDK2'
+        self.state['protein-value.value'] = protein
+        n_confs = min(self.state.get('n-confs-slider.value', 50), N_CONFS_MAX[protein])
+        self.state['n-confs-slider.value'] = n_confs
+        self.fire(['protein-value.value'])
+
+    def slider_burst(self):
+        protein = self.state.get('protein-value.value', 'CDK2')
+        n_confs = self.rng.randint(1, N_CONFS_MAX[protein])
+        for _ in range(self.rng.randint(3, 8)):
+            n_confs = min(max(n_confs + self.rng.randint(-5, 5), 1), N_CONFS_MAX[protein])
+            self.state['n-confs-slider.value'] = n_confs
+            self.fire(['n-confs-slider.value'])
+
+    def metric_change(self):
+        options = self.state['metric-value.options']
+        self.state['metric-value.value'] = self.rng.choice(options)['value']
+        self.fire(['metric-value.value'])
+
+    def selector_change(self):
+        options = self.state['selector-value.options']
+        self.state['selector-value.value'] = self.rng.choice(options)['value']
+        self.fire(['selector-value.value'])
+
+
+def report(results, elapsed):
+    names = sorted(set(r[0] for r in results))
+    print(f"{'callback':<50} {'n':>6} {'err%':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name in names + ['ALL']:
+        subset = [r for r in results if name in ('ALL', r[0])]
+        latencies = np.array([r[1] for r in subset]) * 1000
+        errors = 100 * sum(not r[2] for r in subset) / len(subset)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print(f'{name:<50} {len(subset):>6} {errors:>6.1f} {p50:>8.1f} {p95:>8.1f} {p99:>8.1f}')
+    print(f'Throughput: {len(results) / elapsed:.1f} req/s over {elapsed:.1f} s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='Target an already running server')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--worker-class', default='sync')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    server = None
+    if args.url:
+        url = urlparse(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        host, port = '127.0.0.1', free_port()
+        server = start_server(port, args.workers, args.worker_class, args.threads)
+
+    try:
+        callbacks = get_json(host, port, '/_dash-dependencies')
+        defaults = layout_values(get_json(host, port, '/_dash-layout'))
+
+        results = []
+        start = time.time()
+        clients = [Client(host, port, callbacks, defaults, start + args.duration,
+                          args.seed + i, results)
+                   for i in range(args.clients)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.time() - start
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print(f'clients={args.clients} workers={args.workers} '
+          f'worker-class={args.worker_class} threads={args.threads}')
+    report(results, elapsed)
+
+
+if __name__ == '__main__':
+    main()
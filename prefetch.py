@@ -0,0 +1,77 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import data_source
+from cache import warm
+
+
+# SPECULATIVE PREFETCH
+# After each render_plot request the figures of neighbouring control
+# combinations (next/previous metric or selector) are built in a small
+# background pool and stored in the figure cache.
+class Prefetcher:
+    def __init__(self, max_workers=2, max_pending=12):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = None
+        if max_workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                                thread_name_prefix='prefetch')
+        self._pending = {}  # session -> futures of its last request
+        self._lock = threading.Lock()
+        self.counts = dict(scheduled=0, completed=0, cancelled=0,
+                           dropped=0, failed=0)
+
+    def schedule(self, session, tasks):
+        # tasks: list of (cached_builder, args, kwargs), most likely first
+        if self._executor is None:
+            return
+        with self._lock:
+            # The user moved on: drop the work not started for this session
+            for future in self._pending.get(session, []):
+                if future.cancel():
+                    self.counts['cancelled'] += 1
+            # Forget finished work; what is left counts against the cap
+            self._pending = {key: [f for f in futures if not f.done()]
+                             for key, futures in self._pending.items()}
+            self._pending = {key: futures for key, futures in self._pending.items()
+                             if len(futures) > 0}
+            n_running = sum(len(futures) for futures in self._pending.values())
+            free = max(self.max_pending - n_running, 0)
+            self.counts['dropped'] += max(len(tasks) - free, 0)
+            version = data_source.current_version()
+            futures = [self._executor.submit(self._run, func, args, kwargs, version)
+                       for func, args, kwargs in tasks[:free]]
+            self.counts['scheduled'] += len(futures)
+            self._pending[session] = self._pending.get(session, []) + futures
+
+    def _run(self, func, args, kwargs, version):
+        # Work for a data version that has been replaced is stale
+        if version is not data_source.DATA_VERSION:
+            key = 'cancelled'
+        else:
+            try:
+                with data_source.use_data_version(version):
+                    warm(func, *args, **kwargs)
+                key = 'completed'
+            except Exception:
+                key = 'failed'
+        with self._lock:
+            self.counts[key] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
+
+
+PREFETCHER = Prefetcher(max_workers=int(os.environ.get('PREFETCH_WORKERS', 2)))
+
+
+def neighbours(options, value):
+    # Next and previous option of a control, in display order
+    options = list(options)
+    if value not in options:
+        return []
+    i = options.index(value)
+    return [options[j] for j in (i + 1, i - 1) if 0 <= j < len(options)]